@@ -12,13 +12,11 @@ import q2_skani
 from q2_types.feature_data import FeatureData
 from q2_types.feature_data_mag import MAG
 from qiime2.core.type import Int, Float, Range, Bool, Str, Choices
-from qiime2.plugin import Citations, Plugin
+from qiime2.plugin import Plugin
 from q2_types.distance_matrix import DistanceMatrix
 
 from q2_skani.skani import compare_seqs
 
-citations = Citations.load("citations.bib", package="q2_skani")
-
 plugin = Plugin(
     name="skani",
     version=q2_skani.__version__,
@@ -5,33 +5,315 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
-import glob
+import hashlib
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
+import shlex
+import shutil
 import subprocess
 import tempfile
 import os
-from typing import List, Dict, Any, Literal, Optional, Union
+from typing import (
+    List,
+    Dict,
+    Any,
+    Callable,
+    Iterable,
+    Iterator,
+    Literal,
+    Optional,
+    TextIO,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
 import skbio
 from q2_types.feature_data_mag import MAGSequencesDirFmt
 from q2_types.per_sample_sequences import MultiMAGSequencesDirFmt
 
+T = TypeVar("T")
+
+# Environment variable pointing to where temporary files should be created
+_TMPDIR_ENV = "Q2_SKANI_TMPDIR"
+
+# Number of trailing stderr lines of a failed skani run to report
+_STDERR_TAIL_LINES = 200
+
+# Extension of the genome files; matched with a plain bytes.endswith
+# instead of a glob pattern
+_FASTA_SUFFIX = b".fasta"
+
+# Maximum number of threads used to list genome directories
+_MAX_SCAN_WORKERS = 32
+
+# Size of the buffers used to read skani's output; large reads keep the
+# number of syscalls low when streaming big matrices
+_PIPE_BUFFER_SIZE = 1 << 16
+
+# Number of bytes read at a time when hashing genome files
+_HASH_CHUNK_SIZE = 1 << 20
+
+# Number of characters read at a time when discarding skani's output
+_DISCARD_CHUNK_SIZE = 1 << 16
+
+# dtype of the parsed distances; skani reports at most a few significant
+# digits, so float32 is enough and halves the size of the N x N array;
+# skbio.DistanceMatrix keeps float32 data as is, without a copy
+_DISTANCE_DTYPE = np.float32
+
+# Fixed prefix of every skani triangle command
+_TRIANGLE_CMD = ("skani", "triangle", "-v", "--distance")
+
+# Side length of the square tiles used to mirror lower-triangular matrices;
+# a 64 x 64 float32 tile takes 16 KiB and fits in L1 cache
+_TILE_SIZE = 64
+
+# Mappings of compare_seqs parameters to skani triangle flags
+_VALUE_FLAGS = (
+    ("threads", "-t"),
+    ("min_af", "--min-af"),
+    ("compression", "-c"),
+    ("marker_c", "-m"),
+    ("screen", "-s"),
+)
+_BOOLEAN_FLAGS = (
+    ("ci", "--ci"),
+    ("detailed", "--detailed"),
+    ("diagonal", "--diagonal"),
+    ("sparse", "--sparse"),
+    ("full_matrix", "--full-matrix"),
+    ("median", "--median"),
+    ("no_learned_ani", "--no-learned-ani"),
+    ("robust", "--robust"),
+    ("faster_small", "--faster-small"),
+)
+_PRESET_FLAGS = {
+    "fast": "--fast",
+    "medium": "--medium",
+    "slow": "--slow",
+    "small-genomes": "--small-genomes",
+}
+
+
+def _scan_dir(path: bytes) -> Tuple[List[bytes], List[Tuple[bytes, int]]]:
+    """Split the entries of a directory into subdirectories and FASTA files.
+
+    Empty FASTA files and entries that are not files are left out. The
+    sizes of the FASTA files come from the stat done while filtering them,
+    so that later steps need not stat them again.
+
+    Parameters
+    ----------
+    path : bytes
+        Path to the directory to scan, encoded with os.fsencode
+
+    Returns
+    -------
+    Tuple[List[bytes], List[Tuple[bytes, int]]]
+        Paths to the subdirectories and paths to the FASTA files along with
+        their sizes in bytes
+    """
+    subdirs, fastas = [], []
+    with os.scandir(path) as it:
+        for entry in it:
+            # skip hidden entries, as glob would
+            if entry.name.startswith(b"."):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            # is_file() is answered from the cached d_type for regular files
+            # and filters out e.g. broken symlinks before they are stat-ed;
+            # empty files cannot be sketched, so skani would only skip them
+            elif entry.name.endswith(_FASTA_SUFFIX) and entry.is_file():
+                size = entry.stat().st_size
+                if size:
+                    fastas.append((entry.path, size))
+    return subdirs, fastas
+
+
+def _iter_fastas(root: bytes) -> Iterator[Tuple[bytes, int]]:
+    """Recursively yield all FASTA files found under a directory.
+
+    Parameters
+    ----------
+    root : bytes
+        Path to the directory to search, encoded with os.fsencode
+
+    Yields
+    ------
+    Tuple[bytes, int]
+        Path to a FASTA file and its size in bytes
+    """
+    stack = [root]
+    while stack:
+        subdirs, fastas = _scan_dir(stack.pop())
+        stack.extend(subdirs)
+        yield from fastas
+
+
+def _list_fastas(root: bytes) -> List[Tuple[bytes, int]]:
+    """List all FASTA files found under a directory.
+
+    Top-level subdirectories (e.g. the per-sample directories of
+    a MultiMAGSequencesDirFmt) are walked concurrently, which hides
+    the per-call latency of directory listings on network filesystems.
+
+    Parameters
+    ----------
+    root : bytes
+        Path to the directory to search, encoded with os.fsencode
+
+    Returns
+    -------
+    List[Tuple[bytes, int]]
+        Paths to the FASTA files along with their sizes in bytes
+    """
+    subdirs, fastas = _scan_dir(root)
+    if len(subdirs) < 2:
+        fastas.extend(p for subdir in subdirs for p in _iter_fastas(subdir))
+        return fastas
+
+    workers = min(_MAX_SCAN_WORKERS, len(subdirs))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for paths in executor.map(lambda d: list(_iter_fastas(d)), subdirs):
+            fastas.extend(paths)
+    return fastas
+
+
+def _file_digest(path: bytes) -> bytes:
+    """Compute a digest of a file's content.
+
+    Parameters
+    ----------
+    path : bytes
+        Path to the file
+
+    Returns
+    -------
+    bytes
+        The BLAKE2b digest of the file
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as fh:
+        for chunk in iter(partial(fh.read, _HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def _group_identical(
+    fastas: List[Tuple[bytes, int]],
+) -> Tuple[List[bytes], Dict[str, str]]:
+    """Group genome files with identical content.
+
+    Only files sharing their size with another file need to be hashed.
+
+    Parameters
+    ----------
+    fastas : List[Tuple[bytes, int]]
+        Paths to the genome files along with their sizes in bytes
+
+    Returns
+    -------
+    Tuple[List[bytes], Dict[str, str]]
+        Paths to one representative file per group (in input order) and
+        a mapping of the genome IDs of the other files in each group to the
+        genome ID of its representative
+    """
+    by_size = defaultdict(list)
+    for path, size in fastas:
+        by_size[size].append(path)
+
+    representative_of = {}
+    for group in by_size.values():
+        if len(group) < 2:
+            continue
+        first_with_digest = {}
+        for path in group:
+            first = first_with_digest.setdefault(_file_digest(path), path)
+            if first is not path:
+                representative_of[path] = first
+
+    representatives = [path for path, _ in fastas if path not in representative_of]
+    duplicates = {
+        _genome_id(os.fsdecode(path)): _genome_id(os.fsdecode(first))
+        for path, first in representative_of.items()
+    }
+    return representatives, duplicates
+
+
+def _expand_duplicates(
+    distances: np.ndarray,
+    ids: List[str],
+    genome_ids: List[str],
+    duplicates: Dict[str, str],
+) -> Tuple[np.ndarray, List[str]]:
+    """Add genomes identical to already compared ones to a distance matrix.
+
+    Every duplicate gets a copy of its representative's row and column, and
+    a zero distance to the representative. The rows and columns follow the
+    order of all genomes, so that it does not depend on which of them are
+    identical. Genomes whose representative is missing from the matrix
+    (e.g. because skani could not sketch it) are left out, as they would be
+    without duplicates.
+
+    Parameters
+    ----------
+    distances : np.ndarray
+        The square distance array of the representatives
+    ids : List[str]
+        The genome IDs of the representatives
+    genome_ids : List[str]
+        The genome IDs of all genomes, in the order of the result
+    duplicates : Dict[str, str]
+        Mapping of the genome IDs of the duplicates to the genome IDs of
+        their representatives
+
+    Returns
+    -------
+    Tuple[np.ndarray, List[str]]
+        The expanded distance array and genome IDs
+    """
+    position = {genome_id: i for i, genome_id in enumerate(ids)}
+    rows, expanded_ids = [], []
+    for genome_id in genome_ids:
+        row = position.get(duplicates.get(genome_id, genome_id))
+        if row is not None:
+            rows.append(row)
+            expanded_ids.append(genome_id)
+    return distances[np.ix_(rows, rows)], expanded_ids
+
+
+def _write_genome_list(list_file: str, paths: Iterable[bytes]) -> None:
+    """Write genome paths to a file, one per line, in a single write.
+
+    Parameters
+    ----------
+    list_file : str
+        Path to the file to write
+    paths : Iterable[bytes]
+        Genome paths to write
+    """
+    Path(list_file).write_bytes(b"".join(p + b"\n" for p in paths))
+
 
 def _construct_triangle_cmd(
     fasta_list: str,
-    output_file: str,
     skani_args: Dict[str, Any],
 ) -> List[str]:
     """Construct the Skani command with all parameters.
 
+    The matrix is written to stdout, so no output file is passed.
+
     Parameters
     ----------
     fasta_list : str
         Path to the file containing genome paths
-    output_file : str
-        Path to the output file
     skani_args : Dict[str, Any]
         Dictionary containing all Skani parameters
 
@@ -40,104 +322,198 @@ def _construct_triangle_cmd(
     List[str]
         The constructed Skani command as a list of strings
     """
-    cmd = ["skani", "triangle", "-v", "--distance"]
-
-    # Add required arguments
-    cmd.extend(["-l", fasta_list, "-o", output_file])
-
-    # Define parameter mappings
-    param_with_values = {
-        "threads": "-t",
-        "min_af": "--min-af",
-        "compression": "-c",
-        "marker_c": "-m",
-        "screen": "-s",
-    }
-
-    boolean_flags = {
-        "ci": "--ci",
-        "detailed": "--detailed",
-        "diagonal": "--diagonal",
-        "sparse": "--sparse",
-        "full_matrix": "--full-matrix",
-        "median": "--median",
-        "no_learned_ani": "--no-learned-ani",
-        "robust": "--robust",
-        "faster_small": "--faster-small",
-    }
+    cmd = [*_TRIANGLE_CMD, "-l", fasta_list]
 
     # Add parameters with values
-    for param, flag in param_with_values.items():
-        if param in skani_args:
-            cmd.extend([flag, str(skani_args[param])])
+    for param, flag in _VALUE_FLAGS:
+        value = skani_args.get(param)
+        if value is not None:
+            cmd.extend((flag, str(value)))
 
     # Add boolean flags
-    for param, flag in boolean_flags.items():
-        if param in skani_args and skani_args[param]:
+    for param, flag in _BOOLEAN_FLAGS:
+        if skani_args.get(param):
             cmd.append(flag)
 
     # Add preset if specified (handled differently because the flag is the value itself)
-    if "preset" in skani_args and skani_args["preset"]:
-        cmd.append(f"--{skani_args['preset']}")
+    preset = skani_args.get("preset")
+    if preset:
+        cmd.append(_PRESET_FLAGS[preset])
 
     return cmd
 
 
-def _run_skani(cmd: List[str]) -> None:
+def _run_skani(cmd: List[str], process_output: Callable[[TextIO], T]) -> T:
     """Run Skani with proper error handling.
 
     Parameters
     ----------
     cmd : List[str]
         The command to run as a list of strings
+    process_output : Callable[[TextIO], T]
+        Function consuming Skani's stdout while Skani is running
+
+    Returns
+    -------
+    T
+        The result of process_output
 
     Raises
     ------
     RuntimeError
         If Skani fails to run or returns a non-zero exit code
     """
-    try:
-        result = subprocess.run(
+    # skani's stdout is consumed directly by process_output while its
+    # (potentially very verbose) stderr goes straight to an unlinked
+    # temporary file, which is only read back if skani fails; subprocess
+    # only starts the child with posix_spawn, rather than fork/exec, if the
+    # executable is an absolute path and close_fds is off - leaving the
+    # latter is safe, as Python's own descriptors are non-inheritable
+    with tempfile.TemporaryFile(
+        mode="w+",
+        encoding="utf-8",
+        errors="replace",
+        dir=os.environ.get(_TMPDIR_ENV) or None,
+    ) as stderr:
+        with subprocess.Popen(
             cmd,
-            check=True,
-            capture_output=True,
-            text=True,
-        )
-    except subprocess.CalledProcessError as e:
-        error_msg = (
-            f"Skani failed with exit code {e.returncode}.\n"
-            f"Command: {' '.join(cmd)}\n"
-        )
-        if e.stdout:
-            error_msg += f"stdout:\n{e.stdout}\n"
-        if e.stderr:
-            error_msg += f"stderr:\n{e.stderr}"
-        raise RuntimeError(error_msg)
+            executable=shutil.which(cmd[0]) or cmd[0],
+            close_fds=False,
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+            bufsize=_PIPE_BUFFER_SIZE,
+            # skani writes UTF-8; decoding it explicitly avoids a locale
+            # lookup and never fails on stray invalid bytes
+            encoding="utf-8",
+            errors="replace",
+        ) as proc:
+            try:
+                result = process_output(proc.stdout)
+            except Exception as e:
+                result, output_error = None, e
+                # let skani run to completion (rather than killing it with
+                # a closed pipe) so that its own failures can still be told
+                # apart from errors in processing its output
+                while proc.stdout.read(_DISCARD_CHUNK_SIZE):
+                    pass
+            else:
+                output_error = None
+
+        if proc.returncode != 0:
+            stderr.seek(0)
+            stderr_tail = deque(stderr, maxlen=_STDERR_TAIL_LINES)
+            error_msg = (
+                f"Skani failed with exit code {proc.returncode}.\n"
+                f"Command: {shlex.join(cmd)}\n"
+            )
+            if stderr_tail:
+                error_msg += f"stderr:\n{''.join(stderr_tail)}"
+            raise RuntimeError(error_msg) from output_error
 
+    if output_error is not None:
+        raise output_error
 
-def _process_skani_matrix(matrix_file: str) -> pd.DataFrame:
-    """Process the Skani matrix file into a DistanceMatrix.
+    return result
+
+
+def _genome_id(path: str) -> str:
+    """Derive the genome ID from a genome file path.
 
     Parameters
     ----------
-    matrix_file : str
-        Path to the Skani matrix output file
+    path : str
+        Path to the genome file
 
     Returns
     -------
-    pd.DataFrame
-        The processed distance matrix
+    str
+        The file name without its extension
     """
-    # Read the matrix file
-    df = pd.read_csv(matrix_file, sep="\t", index_col=0, skiprows=1, header=None)
-    df.index = df.index.map(lambda x: Path(x).stem)
-    df.columns = df.index.tolist()
+    name = os.path.basename(path)
+    stem, _, _ = name.rpartition(".")
+    return stem or name
 
-    # Convert ANI to distance if needed (100 - ANI)
-    # if not df.values[0, 0] > 1:  # If values are ANI (0-100)
-    #     df = 100 - df
 
-    return df
+def _mirror_lower(distances: np.ndarray) -> None:
+    """Make a lower-triangular distance array symmetric, in place.
+
+    The lower triangle is copied onto the upper one in square tiles, so
+    that the transposed reads and writes of each tile stay in cache and no
+    N x N index arrays are needed. The diagonal, which is either missing
+    or holds the (zero) self-distances, is set to zero.
+
+    Parameters
+    ----------
+    distances : np.ndarray
+        The square distance array, of which only the lower triangle is used
+    """
+    n = distances.shape[0]
+    for i0 in range(0, n, _TILE_SIZE):
+        i1 = min(i0 + _TILE_SIZE, n)
+        tile = distances[i0:i1, i0:i1]
+        upper = np.triu_indices(i1 - i0, 1)
+        tile[upper] = tile.T[upper]
+        for j0 in range(i1, n, _TILE_SIZE):
+            j1 = min(j0 + _TILE_SIZE, n)
+            distances[i0:i1, j0:j1] = distances[j0:j1, i0:i1].T
+    np.fill_diagonal(distances, 0)
+
+
+def _process_skani_matrix(
+    matrix: Union[str, TextIO], full_matrix: bool = True
+) -> Tuple[np.ndarray, List[str]]:
+    """Process the Skani matrix output into distances and genome IDs.
+
+    Parameters
+    ----------
+    matrix : str | TextIO
+        Path to the Skani matrix output file or a stream of its content
+    full_matrix : bool, optional
+        Whether the matrix is a full one rather than skani's default
+        lower-triangular one, by default True
+
+    Returns
+    -------
+    Tuple[np.ndarray, List[str]]
+        The square distance array and the genome IDs of its rows/columns
+
+    Raises
+    ------
+    ValueError
+        If the file is not a valid square skani matrix
+    """
+    if isinstance(matrix, str):
+        with open(matrix) as fh:
+            return _process_skani_matrix(fh, full_matrix=full_matrix)
+
+    # the first line holds the number of genomes; naming all columns upfront
+    # lets the C parser pad the short rows of a lower-triangular matrix
+    n_genomes = int(matrix.readline())
+    df = pd.read_csv(
+        matrix,
+        sep="\t",
+        header=None,
+        names=range(n_genomes + 1),
+        index_col=0,
+        engine="c",
+        dtype=defaultdict(lambda: _DISTANCE_DTYPE, {0: str}),
+    )
+    if df.shape != (n_genomes, n_genomes):
+        raise ValueError(
+            f"Expected a {n_genomes}x{n_genomes} skani matrix, "
+            f"found {df.shape[0]}x{df.shape[1]}."
+        )
+    ids = [_genome_id(path) for path in df.index]
+
+    # skani is run with --distance, so the values are already 100 - ANI
+    # and need no further transformation
+    distances = df.to_numpy(dtype=_DISTANCE_DTYPE, copy=False)
+    if not full_matrix:
+        if not distances.flags.writeable:
+            distances = distances.copy()
+        _mirror_lower(distances)
+
+    return distances, ids
 
 
 def compare_seqs(
@@ -199,45 +575,79 @@ def compare_seqs(
     -------
     skbio.DistanceMatrix
         The distance matrix
+
+    Notes
+    -----
+    The genome list is written to a temporary directory created under
+    ``$Q2_SKANI_TMPDIR`` if set and non-empty (e.g. ``/dev/shm`` to keep it
+    in memory), or under the default temporary location otherwise. The
+    distance matrix is read directly from skani's stdout and never written
+    to disk.
+
+    Genome files with identical content are passed to skani only once; the
+    copies are added back to the result with a zero distance between them.
+    If all genomes are identical, skani is not run at all.
+
+    Every call works in its own temporary directory and waits on its own
+    skani process, so independent genome sets can be compared concurrently
+    from a thread pool (e.g. ``concurrent.futures.ThreadPoolExecutor``);
+    choose ``threads`` so that the combined number of skani threads does
+    not exceed the available cores.
     """
-    # Filter locals() to only include function parameters, excluding 'genomes'
     skani_args = {
-        k: v
-        for k, v in locals().items()
-        if k
-        not in {
-            "genomes",
-        }
+        "threads": threads,
+        "min_af": min_af,
+        "compression": compression,
+        "marker_c": marker_c,
+        "screen": screen,
+        "ci": ci,
+        "detailed": detailed,
+        "diagonal": diagonal,
+        "sparse": sparse,
+        "full_matrix": full_matrix,
+        "median": median,
+        "no_learned_ani": no_learned_ani,
+        "robust": robust,
+        "faster_small": faster_small,
+        "preset": preset,
     }
 
     # Create a temporary directory for Skani input/output
-    with tempfile.TemporaryDirectory() as temp_dir:
-        # Create a list file containing paths to all genomes
+    with tempfile.TemporaryDirectory(
+        dir=os.environ.get(_TMPDIR_ENV) or None
+    ) as temp_dir:
+        # Create a list file containing paths to all genomes, sorted so that
+        # the order of the genomes in the result does not depend on the
+        # filesystem
         list_file = os.path.join(temp_dir, "genome_list.txt")
-        with open(list_file, "w") as f:
-            f.writelines(
-                f"{str(p)}\n"
-                for p in glob.glob(str(genomes.path / "**" / "*.fasta"), recursive=True)
-            )
+        fastas = sorted(_list_fastas(os.fsencode(genomes.path)))
 
-        # Run Skani in triangle mode
-        output_file = os.path.join(temp_dir, "skani_output.tsv")
+        # Identical genomes are compared only once and added back afterwards
+        representatives, duplicates = _group_identical(fastas)
+        if duplicates and len(representatives) == 1:
+            # all genomes are identical, so there is nothing to run skani on
+            ids = [_genome_id(os.fsdecode(path)) for path, _ in fastas]
+            distances = np.zeros((len(ids), len(ids)), dtype=_DISTANCE_DTYPE)
+            return skbio.DistanceMatrix(distances, ids=ids)
+        _write_genome_list(list_file, representatives)
 
-        # Construct and run the Skani command
-        cmd = _construct_triangle_cmd(
-            fasta_list=list_file,
-            output_file=output_file,
-            skani_args=skani_args,
-        )
+        # Construct and run the Skani command, reading the matrix from its
+        # output as it is produced
+        cmd = _construct_triangle_cmd(fasta_list=list_file, skani_args=skani_args)
 
         try:
-            _run_skani(cmd)
-        except Exception as e:
-            raise RuntimeError(
-                f"Failed to run Skani comparison: {str(e)}\n"
-                f"Command: {' '.join(cmd)}"
+            distances, ids = _run_skani(
+                cmd, partial(_process_skani_matrix, full_matrix=full_matrix)
             )
+        except Exception as e:
+            # the command is only repeated if _run_skani did not report it
+            error_msg = f"Failed to run Skani comparison: {str(e)}"
+            if not isinstance(e, RuntimeError):
+                error_msg += f"\nCommand: {shlex.join(cmd)}"
+            raise RuntimeError(error_msg) from e
+
+        if duplicates:
+            genome_ids = [_genome_id(os.fsdecode(path)) for path, _ in fastas]
+            distances, ids = _expand_duplicates(distances, ids, genome_ids, duplicates)
 
-        # Process the matrix file into a DistanceMatrix
-        df = _process_skani_matrix(output_file)
-        return skbio.DistanceMatrix(df.values, ids=df.index.tolist())
+        return skbio.DistanceMatrix(distances, ids=ids)
@@ -6,378 +6,555 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import importlib.resources
+import io
+import os
+import shlex
+import subprocess
+import sys
 import tempfile
+import unittest
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 from unittest.mock import patch
 
-import pandas as pd
+import numpy as np
 from qiime2.plugin.testing import TestPluginBase
 
 from q2_skani.skani import (
     compare_seqs,
-    _construct_skani_cmd,
+    _DISTANCE_DTYPE,
+    _construct_triangle_cmd,
+    _expand_duplicates,
+    _genome_id,
+    _group_identical,
+    _iter_fastas,
+    _list_fastas,
+    _mirror_lower,
     _process_skani_matrix,
-    compare_seqs_skani,
+    _run_skani,
+    _write_genome_list,
 )
 
 
-class FastANITests(TestPluginBase):
+class SkaniTests(TestPluginBase):
     package = "q2_skani.tests"
 
-    def setUp(self):
-        """Set up test data."""
-        super().setUp()
-        self.test_data_dir = Path(self.temp_dir.name) / "test_data"
-        self.test_data_dir.mkdir()
-        # Create a mock for subprocess.run that will be used in all tests
-        self.mock_subprocess = patch("subprocess.run").start()
-        self.addCleanup(patch.stopall)
-
-    def test_fastani_never_called(self):
-        """Test that FastANI is never actually called."""
-        # Create mock MAG sequences
-        mags = MockMAGSequencesDirFmt(["genome1.fasta", "genome2.fasta"])
-
-        # Mock the FastANI command execution
-        def mock_run_fastani(cmd: List[str]):
-            # Create mock output files
-            output_dir = Path(cmd[cmd.index("--output") + 1]).parent
-            matrix_file = output_dir / "fastani_output.tsv.matrix"
-            # Copy the test matrix file to the output location
-            with open(self.get_data_path("test.matrix"), "r") as src:
-                with open(matrix_file, "w") as dst:
-                    dst.write(src.read())
-
-        self.monkeypatch.setattr("q2_skani._methods._run_fastani", mock_run_fastani)
-
-        # Run the comparison
-        compare_seqs(
-            genomes=mags,
-            kmer=16,
-            fragLen=3000,
-            threads=1,
-            minFraction=0.2,
-            maxRatioDiff=0.05,
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # fixtures are looked up once per class; the full matrix is also
+        # read once and shared by all tests mocking skani's output
+        cls.data_dir = importlib.resources.files(cls.package) / "data"
+        cls.full_matrix = str(cls.data_dir / "skani_full.matrix")
+        cls.full_matrix_text = (cls.data_dir / "skani_full.matrix").read_text()
+
+    def test_iter_fastas(self):
+        """Test recursive discovery of FASTA files."""
+        root = Path(self.temp_dir.name) / "mags"
+        (root / "sample1").mkdir(parents=True)
+        (root / "sample2").mkdir()
+        (root / ".hidden").mkdir()
+        for name in [
+            "sample1/mag1.fasta",
+            "sample1/mag2.fasta",
+            "sample2/mag3.fasta",
+            "sample2/notes.txt",
+            ".hidden/mag4.fasta",
+        ]:
+            (root / name).write_text(">contig1\nACGT\n")
+        (root / "sample2" / "empty.fasta").touch()
+        (root / "sample2" / "broken.fasta").symlink_to(root / "missing.fasta")
+        (root / "sample2" / "dir.fasta").mkdir()
+
+        obs = sorted(_iter_fastas(os.fsencode(root)))
+
+        exp = sorted(
+            (os.fsencode(root / name), 14)
+            for name in [
+                "sample1/mag1.fasta",
+                "sample1/mag2.fasta",
+                "sample2/mag3.fasta",
+            ]
+        )
+        self.assertEqual(obs, exp)
+
+    def test_list_fastas(self):
+        """Test listing FASTA files across per-sample directories."""
+        root = Path(self.temp_dir.name) / "mags"
+        exp = [os.fsencode(root / "mag0.fasta")]
+        for i in range(1, 6):
+            (root / f"sample{i}" / "nested").mkdir(parents=True)
+            exp.append(os.fsencode(root / f"sample{i}" / f"mag{i}.fasta"))
+            exp.append(os.fsencode(root / f"sample{i}" / "nested" / "mag.fasta"))
+        (root / "sample1" / "notes.txt").touch()
+        for path in exp:
+            Path(os.fsdecode(path)).write_text(">contig1\nACGT\n")
+
+        obs = _list_fastas(os.fsencode(root))
+
+        self.assertEqual(sorted(obs), sorted((path, 14) for path in exp))
+
+    def test_group_identical(self):
+        """Test grouping of genome files with identical content."""
+        root = Path(self.temp_dir.name)
+        contents = {
+            "mag1.fasta": ">c1\nACGT\n",
+            "mag2.fasta": ">c1\nACGA\n",
+            "mag3.fasta": ">c1\nACGT\n",
+            "mag4.fasta": ">c1\nACGTACGT\n",
+            "mag5.fasta": ">c1\nACGT\n",
+        }
+        fastas = []
+        for name, content in contents.items():
+            (root / name).write_text(content)
+            fastas.append((os.fsencode(root / name), len(content)))
+        paths = [path for path, _ in fastas]
+
+        with patch("q2_skani.skani.os.stat") as mock_stat:
+            representatives, duplicates = _group_identical(fastas)
+
+        # the sizes from the directory scan are used as they are
+        mock_stat.assert_not_called()
+
+        self.assertEqual(representatives, [paths[0], paths[1], paths[3]])
+        self.assertEqual(duplicates, {"mag3": "mag1", "mag5": "mag1"})
+
+    def test_expand_duplicates(self):
+        """Test adding identical genomes back to a distance matrix."""
+        distances = np.array([[0.0, 1.0, 2.0], [1.0, 0.0, 3.0], [2.0, 3.0, 0.0]])
+
+        obs, ids = _expand_duplicates(
+            distances,
+            ["a", "b", "c"],
+            ["a", "a2", "b", "c", "c2", "c3"],
+            {"a2": "a", "c2": "c", "c3": "c"},
         )
 
-        # Verify that subprocess.run was never called
-        self.mock_subprocess.assert_not_called()
-
-    def test_construct_fastani_cmd(self):
-        """Test command construction with various parameters."""
-        # Test with minimal required parameters
-        cmd = _construct_fastani_cmd(
-            query_list="query.txt",
-            ref_list="ref.txt",
-            output_file="output.tsv",
-            fastani_args={},
+        self.assertEqual(ids, ["a", "a2", "b", "c", "c2", "c3"])
+        np.testing.assert_array_equal(
+            obs,
+            [
+                [0.0, 0.0, 1.0, 2.0, 2.0, 2.0],
+                [0.0, 0.0, 1.0, 2.0, 2.0, 2.0],
+                [1.0, 1.0, 0.0, 3.0, 3.0, 3.0],
+                [2.0, 2.0, 3.0, 0.0, 0.0, 0.0],
+                [2.0, 2.0, 3.0, 0.0, 0.0, 0.0],
+                [2.0, 2.0, 3.0, 0.0, 0.0, 0.0],
+            ],
         )
+
+    def test_expand_duplicates_missing(self):
+        """Test that genomes missing from skani's matrix are left out."""
+        distances = np.array([[0.0, 1.0], [1.0, 0.0]])
+
+        obs, ids = _expand_duplicates(
+            distances, ["a", "c"], ["a", "a2", "b", "c"], {"a2": "a"}
+        )
+
+        self.assertEqual(ids, ["a", "a2", "c"])
+        np.testing.assert_array_equal(
+            obs, [[0.0, 0.0, 1.0], [0.0, 0.0, 1.0], [1.0, 1.0, 0.0]]
+        )
+
+    def test_write_genome_list(self):
+        """Test writing genome paths to the list file."""
+        list_file = Path(self.temp_dir.name) / "genome_list.txt"
+        paths = [f"/data/mag{i}.fasta".encode() for i in range(10)]
+
+        _write_genome_list(str(list_file), iter(paths))
+
+        self.assertEqual(list_file.read_bytes().splitlines(), paths)
+
+    def test_construct_triangle_cmd_minimal(self):
+        """Test triangle command construction without optional parameters."""
+        cmd = _construct_triangle_cmd(fasta_list="genomes.txt", skani_args={})
+
         self.assertEqual(
             cmd,
             [
-                "fastANI",
-                "--queryList",
-                "query.txt",
-                "--refList",
-                "ref.txt",
-                "--output",
-                "output.tsv",
-                "--matrix",
+                "skani",
+                "triangle",
+                "-v",
+                "--distance",
+                "-l",
+                "genomes.txt",
             ],
         )
 
-        # Test with all optional parameters
-        cmd = _construct_fastani_cmd(
-            query_list="query.txt",
-            ref_list="ref.txt",
-            output_file="output.tsv",
-            fastani_args={
-                "kmer": 16,
-                "fragLen": 3000,
+    def test_construct_triangle_cmd_all_opts(self):
+        """Test triangle command construction with all parameters."""
+        cmd = _construct_triangle_cmd(
+            fasta_list="genomes.txt",
+            skani_args={
                 "threads": 4,
-                "minFraction": 0.2,
-                "maxRatioDiff": 0.05,
+                "min_af": 20.0,
+                "compression": 100,
+                "marker_c": 500,
+                "screen": 85.0,
+                "ci": True,
+                "detailed": True,
+                "diagonal": True,
+                "sparse": True,
+                "full_matrix": True,
+                "median": True,
+                "no_learned_ani": True,
+                "robust": True,
+                "faster_small": True,
+                "preset": "slow",
             },
         )
-        self.assertEqual(
-            cmd,
-            [
-                "fastANI",
-                "--queryList",
-                "query.txt",
-                "--refList",
-                "ref.txt",
-                "--output",
-                "output.tsv",
-                "--matrix",
-                "--kmer",
-                "16",
-                "--fragLen",
-                "3000",
-                "--threads",
-                "4",
-                "--minFraction",
-                "0.2",
-                "--maxRatioDiff",
-                "0.05",
-            ],
+
+        exp = [
+            "skani",
+            "triangle",
+            "-v",
+            "--distance",
+            "-l",
+            "genomes.txt",
+            "-t",
+            "4",
+            "--min-af",
+            "20.0",
+            "-c",
+            "100",
+            "-m",
+            "500",
+            "-s",
+            "85.0",
+            "--ci",
+            "--detailed",
+            "--diagonal",
+            "--sparse",
+            "--full-matrix",
+            "--median",
+            "--no-learned-ani",
+            "--robust",
+            "--faster-small",
+            "--slow",
+        ]
+        self.assertEqual(cmd, exp)
+
+    def test_construct_triangle_cmd_skips_unset(self):
+        """Test that unset and disabled parameters are not passed on."""
+        cmd = _construct_triangle_cmd(
+            fasta_list="genomes.txt",
+            skani_args={"threads": None, "ci": False, "preset": None},
+        )
+
+        self.assertEqual(cmd[6:], [])
+
+    def test_genome_id(self):
+        """Test deriving genome IDs from file paths."""
+        self.assertEqual(_genome_id("/data/sample1/mag1.fasta"), "mag1")
+        self.assertEqual(_genome_id("/data/mag1.contigs.fasta"), "mag1.contigs")
+        self.assertEqual(_genome_id("/data/mag1"), "mag1")
+
+    def test_process_skani_matrix_full(self):
+        """Test processing of a full skani distance matrix."""
+        distances, ids = _process_skani_matrix(self.full_matrix)
+
+        self.assertIsInstance(distances, np.ndarray)
+        self.assertEqual(distances.shape, (3, 3))
+        self.assertEqual(ids, ["genome1", "genome2", "genome3"])
+        self.assertEqual(distances.dtype, _DISTANCE_DTYPE)
+        self.assertAlmostEqual(distances[0, 1], 4.52, places=5)
+        self.assertAlmostEqual(distances[2, 1], 19.87, places=5)
+        self.assertEqual(distances[0, 0], 0.0)
+
+    def test_process_skani_matrix_lower(self):
+        """Test processing of a lower-triangular skani distance matrix."""
+        distances, ids = _process_skani_matrix(
+            str(self.data_dir / "skani_lower.matrix"), full_matrix=False
         )
 
-    def test_process_fastani_matrix(self):
-        """Test processing of FastANI matrix output."""
-        # Use the test matrix file
-        matrix_file = self.get_data_path("test.matrix")
-
-        # Process the matrix
-        df = _process_fastani_matrix(str(matrix_file))
-
-        # Check the results
-        self.assertIsInstance(df, pd.DataFrame)
-        self.assertEqual(df.shape, (3, 3))
-        self.assertEqual(list(df.index), ["genome1", "genome2", "genome3"])
-        self.assertEqual(list(df.columns), ["genome1", "genome2", "genome3"])
-        self.assertEqual(df.loc["genome1", "genome2"], 99.9)  # 100 - 0.1
-        self.assertEqual(df.loc["genome2", "genome1"], 99.9)  # Symmetric
-        self.assertEqual(df.loc["genome1", "genome1"], 0.0)  # Self-comparison
-
-    def test_process_fastani_matrix_with_na(self):
-        """Test processing of FastANI matrix with NA values."""
-        # Use the test matrix file with NA values
-        matrix_file = self.get_data_path("test_na.matrix")
-
-        # Process the matrix
-        df = _process_fastani_matrix(str(matrix_file))
-
-        # Check the results
-        self.assertIsInstance(df, pd.DataFrame)
-        self.assertEqual(df.shape, (3, 3))
-        self.assertTrue(pd.isna(df.loc["genome1", "genome2"]))
-        self.assertTrue(pd.isna(df.loc["genome2", "genome1"]))
-
-    def test_process_fastani_matrix_invalid_file(self):
-        """Test error handling for invalid matrix file."""
-        # Use the invalid test matrix file
-        matrix_file = self.get_data_path("test_invalid.matrix")
-
-        # Test that processing raises an error
+        exp, _ = _process_skani_matrix(self.full_matrix)
+        self.assertEqual(ids, ["genome1", "genome2", "genome3"])
+        np.testing.assert_array_equal(distances, exp)
+
+    def test_process_skani_matrix_golden(self):
+        """Test a parsed full matrix against a golden array.
+
+        The golden array holds the values of skani_full.matrix and was
+        generated, from within the data directory, with::
+
+            np.save(
+                "skani_full.npy",
+                np.array(
+                    [[0.0, 4.52, 21.30], [4.52, 0.0, 19.87], [21.30, 19.87, 0.0]],
+                    dtype=np.float32,
+                ),
+            )
+        """
+        exp = np.load(str(self.data_dir / "skani_full.npy"))
+
+        obs, _ = _process_skani_matrix(self.full_matrix)
+
+        np.testing.assert_array_equal(obs, exp)
+
+    def test_mirror_lower(self):
+        """Test tiled mirroring of lower-triangular arrays."""
+        rng = np.random.default_rng(42)
+        for n in (1, 7, 8, 9, 30):
+            lower = np.tril(rng.random((n, n), dtype=np.float32), -1)
+            obs = lower.copy()
+            obs[np.triu_indices(n)] = np.nan
+
+            with patch("q2_skani.skani._TILE_SIZE", 8):
+                _mirror_lower(obs)
+
+            np.testing.assert_array_equal(obs, lower + lower.T)
+
+    def test_process_skani_matrix_invalid(self):
+        """Test error handling for malformed skani matrices."""
         with self.assertRaises(ValueError):
-            _process_fastani_matrix(str(matrix_file))
+            _process_skani_matrix(str(self.data_dir / "test_invalid.matrix"))
+
+        truncated = Path(self.temp_dir.name) / "truncated.matrix"
+        lines = self.full_matrix_text
+        truncated.write_text("".join(lines.splitlines(keepends=True)[:-1]))
+        with self.assertRaisesRegex(ValueError, "Expected a 3x3 skani matrix"):
+            _process_skani_matrix(str(truncated))
+
+        too_wide = Path(self.temp_dir.name) / "too_wide.matrix"
+        too_wide.write_text(lines.replace("\t0.00\n", "\t0.00\t1.00\n", 1))
+        with self.assertRaises(ValueError):
+            _process_skani_matrix(str(too_wide))
 
     def test_compare_seqs(self):
         """Test the main compare_seqs function."""
-        # Create mock MAG sequences
-        mags = MockMAGSequencesDirFmt(["genome1.fasta", "genome2.fasta"])
-
-        # Mock the FastANI command execution
-        def mock_run_fastani(cmd: List[str]):
-            # Create mock output files
-            output_dir = Path(cmd[cmd.index("--output") + 1]).parent
-            matrix_file = output_dir / "fastani_output.tsv.matrix"
-            # Copy the test matrix file to the output location
-            with open(self.get_data_path("test.matrix"), "r") as src:
-                with open(matrix_file, "w") as dst:
-                    dst.write(src.read())
-
-        self.monkeypatch.setattr("q2_skani._methods._run_fastani", mock_run_fastani)
-
-        # Run the comparison
-        result = compare_seqs(
-            genomes=mags,
-            kmer=16,
-            fragLen=3000,
-            threads=1,
-            minFraction=0.2,
-            maxRatioDiff=0.05,
+        mags = MockMAGSequencesDirFmt(
+            ["genome1.fasta", "genome2.fasta"], self.temp_dir.name
+        )
+
+        def fake_run(cmd, process_output):
+            list_file = Path(cmd[cmd.index("-l") + 1])
+            self.assertEqual(
+                list_file.read_text().splitlines(),
+                [str(mags.path / "genome1.fasta"), str(mags.path / "genome2.fasta")],
+            )
+            return process_output(io.StringIO(self.full_matrix_text))
+
+        with patch("q2_skani.skani._run_skani", side_effect=fake_run) as mock:
+            dm = compare_seqs(genomes=mags, threads=2, preset="fast")
+
+        # the parsed array is used as is, without a copy
+        self.assertEqual(dm.data.dtype, _DISTANCE_DTYPE)
+
+        cmd = mock.call_args.args[0]
+        self.assertEqual(cmd[cmd.index("-t") + 1], "2")
+        self.assertIn("--full-matrix", cmd)
+        self.assertEqual(cmd[-1], "--fast")
+        self.assertEqual(dm.shape, (3, 3))
+        self.assertEqual(dm.ids, ("genome1", "genome2", "genome3"))
+        self.assertAlmostEqual(dm["genome1", "genome2"], 4.52, places=5)
+
+    def test_compare_seqs_identical_genomes(self):
+        """Test that identical genomes are compared by skani only once."""
+        mags = MockMAGSequencesDirFmt(
+            ["genome1.fasta", "genome2.fasta"], self.temp_dir.name
+        )
+        (mags.path / "genome3.fasta").write_text(
+            (mags.path / "genome1.fasta").read_text()
+        )
+        matrix = "2\ngenome1.fasta\t0.00\t4.52\ngenome2.fasta\t4.52\t0.00\n"
+
+        def fake_run(cmd, process_output):
+            list_file = Path(cmd[cmd.index("-l") + 1])
+            self.assertEqual(
+                list_file.read_text().splitlines(),
+                [str(mags.path / "genome1.fasta"), str(mags.path / "genome2.fasta")],
+            )
+            return process_output(io.StringIO(matrix))
+
+        with patch("q2_skani.skani._run_skani", side_effect=fake_run):
+            dm = compare_seqs(genomes=mags)
+
+        # the genomes keep their sorted order
+        self.assertEqual(dm.ids, ("genome1", "genome2", "genome3"))
+        self.assertEqual(dm["genome1", "genome3"], 0.0)
+        self.assertAlmostEqual(dm["genome3", "genome2"], 4.52, places=5)
+
+    def test_compare_seqs_identical_genomes_missing(self):
+        """Test identical genomes when skani leaves a genome out."""
+        mags = MockMAGSequencesDirFmt(
+            ["genome1.fasta", "genome2.fasta"], self.temp_dir.name
+        )
+        (mags.path / "genome3.fasta").write_text(
+            (mags.path / "genome1.fasta").read_text()
+        )
+        # skani could not sketch genome2
+        matrix = "1\ngenome1.fasta\t0.00\n"
+
+        with patch(
+            "q2_skani.skani._run_skani",
+            side_effect=lambda cmd, process_output: process_output(io.StringIO(matrix)),
+        ):
+            dm = compare_seqs(genomes=mags)
+
+        self.assertEqual(dm.ids, ("genome1", "genome3"))
+        self.assertEqual(dm["genome1", "genome3"], 0.0)
+
+    def test_compare_seqs_all_identical(self):
+        """Test that skani is not run if all genomes are identical."""
+        mags = MockMAGSequencesDirFmt(["genome1.fasta"], self.temp_dir.name)
+        (mags.path / "genome2.fasta").write_text(
+            (mags.path / "genome1.fasta").read_text()
         )
 
-        # Check the results
-        self.assertIsInstance(result, pd.DataFrame)
-        self.assertEqual(result.shape, (3, 3))
-        self.assertEqual(list(result.index), ["genome1", "genome2", "genome3"])
-        self.assertEqual(result.loc["genome1", "genome2"], 99.9)
+        with patch("q2_skani.skani._run_skani") as mock:
+            dm = compare_seqs(genomes=mags)
 
-    def test_compare_seqs_no_fasta_files(self):
-        """Test error handling when no FASTA files are found."""
-        # Create mock MAG sequences with no FASTA files
-        mags = MockMAGSequencesDirFmt([])
+        mock.assert_not_called()
+        self.assertEqual(dm.ids, ("genome1", "genome2"))
+        np.testing.assert_array_equal(dm.data, np.zeros((2, 2)))
 
-        # Test that comparison raises an error
-        with self.assertRaisesRegex(RuntimeError, "No FASTA files found"):
+    def test_compare_seqs_skani_error(self):
+        """Test error handling when skani fails."""
+        mags = MockMAGSequencesDirFmt(["genome1.fasta"], self.temp_dir.name)
+
+        with patch(
+            "q2_skani.skani._run_skani",
+            side_effect=RuntimeError("Skani failed with exit code 1."),
+        ):
+            with self.assertRaisesRegex(
+                RuntimeError, "Failed to run Skani comparison: Skani failed"
+            ):
+                compare_seqs(genomes=mags)
+
+    def test_compare_seqs_skani_missing(self):
+        """Test that the command is reported when skani cannot be started."""
+        mags = MockMAGSequencesDirFmt(["genome1.fasta"], self.temp_dir.name)
+
+        with patch("q2_skani.skani._run_skani", side_effect=FileNotFoundError("skani")):
+            with self.assertRaisesRegex(RuntimeError, "Command: skani triangle"):
+                compare_seqs(genomes=mags)
+
+    def test_compare_seqs_custom_tmpdir(self):
+        """Test that intermediate files are created under Q2_SKANI_TMPDIR."""
+        mags = MockMAGSequencesDirFmt(["genome1.fasta"], self.temp_dir.name)
+        tmp_root = Path(self.temp_dir.name) / "scratch"
+        tmp_root.mkdir()
+
+        def fake_run(cmd, process_output):
+            list_file = Path(cmd[cmd.index("-l") + 1])
+            self.assertEqual(list_file.parent.parent, tmp_root)
+            return process_output(io.StringIO(self.full_matrix_text))
+
+        with patch.dict(os.environ, {"Q2_SKANI_TMPDIR": str(tmp_root)}), patch(
+            "q2_skani.skani._run_skani", side_effect=fake_run
+        ) as mock:
             compare_seqs(genomes=mags)
 
-    def test_compare_seqs_fastani_error(self):
-        """Test error handling when FastANI fails."""
-        # Create mock MAG sequences
-        mags = MockMAGSequencesDirFmt(["genome1.fasta"])
+        mock.assert_called_once()
+        self.assertEqual(list(tmp_root.iterdir()), [])
 
-        # Mock FastANI to raise an error
-        def mock_run_fastani(cmd: List[str]):
-            raise RuntimeError("FastANI failed")
+    def test_compare_seqs_empty_tmpdir(self):
+        """Test that an empty Q2_SKANI_TMPDIR is treated as unset."""
+        mags = MockMAGSequencesDirFmt(["genome1.fasta"], self.temp_dir.name)
 
-        self.monkeypatch.setattr("q2_skani._methods._run_fastani", mock_run_fastani)
+        def fake_run(cmd, process_output):
+            list_file = Path(cmd[cmd.index("-l") + 1])
+            self.assertTrue(list_file.is_absolute())
+            self.assertEqual(list_file.parent.parent, Path(tempfile.gettempdir()))
+            return process_output(io.StringIO(self.full_matrix_text))
 
-        # Test that comparison raises an error
-        with self.assertRaisesRegex(RuntimeError, "Failed to run FastANI comparison"):
+        with patch.dict(os.environ, {"Q2_SKANI_TMPDIR": ""}), patch(
+            "q2_skani.skani._run_skani", side_effect=fake_run
+        ) as mock:
             compare_seqs(genomes=mags)
 
-    def test_construct_skani_cmd(self):
-        """Test skani command construction with various parameters."""
-        # Test with minimal required parameters
-        cmd = _construct_skani_cmd(
-            query_list="query.txt",
-            ref_list="ref.txt",
-            output_file="output.tsv",
-            skani_args={},
-        )
-        self.assertEqual(
-            cmd,
-            [
-                "skani",
-                "dist",
-                "-q",
-                "query.txt",
-                "-r",
-                "ref.txt",
-                "-o",
-                "output.tsv",
-            ],
-        )
+        mock.assert_called_once()
 
-        # Test with all optional parameters
-        cmd = _construct_skani_cmd(
-            query_list="query.txt",
-            ref_list="ref.txt",
-            output_file="output.tsv",
-            skani_args={
-                "threads": 4,
-                "min_fraction": 0.2,
-                "min_ani": 80.0,
-                "small_genomes": True,
-            },
-        )
-        self.assertEqual(
-            cmd,
-            [
-                "skani",
-                "dist",
-                "-q",
-                "query.txt",
-                "-r",
-                "ref.txt",
-                "-o",
-                "output.tsv",
-                "-t",
-                "4",
-                "-m",
-                "0.2",
-                "-c",
-                "80.0",
-                "--small-genomes",
-            ],
-        )
+    def test_run_skani_success(self):
+        """Test that skani's output is passed on while it is running."""
+        script = "import sys; print('all good'); print('done', file=sys.stderr)"
+
+        obs = _run_skani([sys.executable, "-c", script], lambda fh: fh.read())
+
+        self.assertEqual(obs, "all good\n")
+
+    def test_run_skani_output_error(self):
+        """Test that errors raised while reading the output are propagated."""
+        script = "print('not a matrix\\n' * 100000)"
 
-    def test_process_skani_matrix(self):
-        """Test processing of skani matrix output."""
-        # Use the test matrix file
-        matrix_file = self.get_data_path("test.matrix")
-
-        # Process the matrix
-        df = _process_skani_matrix(str(matrix_file))
-
-        # Check the results
-        self.assertIsInstance(df, pd.DataFrame)
-        self.assertEqual(df.shape, (3, 3))
-        self.assertEqual(list(df.index), ["genome1", "genome2", "genome3"])
-        self.assertEqual(list(df.columns), ["genome1", "genome2", "genome3"])
-        self.assertEqual(df.loc["genome1", "genome2"], 99.9)  # 100 - 0.1
-        self.assertEqual(df.loc["genome2", "genome1"], 99.9)  # Symmetric
-        self.assertEqual(df.loc["genome1", "genome1"], 0.0)  # Self-comparison
-
-    def test_process_skani_matrix_with_na(self):
-        """Test processing of skani matrix with NA values."""
-        # Use the test matrix file with NA values
-        matrix_file = self.get_data_path("test_na.matrix")
-
-        # Process the matrix
-        df = _process_skani_matrix(str(matrix_file))
-
-        # Check the results
-        self.assertIsInstance(df, pd.DataFrame)
-        self.assertEqual(df.shape, (3, 3))
-        self.assertTrue(pd.isna(df.loc["genome1", "genome2"]))
-        self.assertTrue(pd.isna(df.loc["genome2", "genome1"]))
-
-    def test_process_skani_matrix_invalid_file(self):
-        """Test error handling for invalid matrix file."""
-        # Use the invalid test matrix file
-        matrix_file = self.get_data_path("test_invalid.matrix")
-
-        # Test that processing raises an error
         with self.assertRaises(ValueError):
-            _process_skani_matrix(str(matrix_file))
-
-    def test_compare_seqs_skani(self):
-        """Test the main compare_seqs_skani function."""
-        # Create mock MAG sequences
-        mags = MockMAGSequencesDirFmt(["genome1.fasta", "genome2.fasta"])
-
-        # Mock the skani command execution
-        def mock_run_skani(cmd: List[str]):
-            # Create mock output files
-            output_dir = Path(cmd[cmd.index("-o") + 1]).parent
-            matrix_file = output_dir / "skani_output.tsv.matrix"
-            # Copy the test matrix file to the output location
-            with open(self.get_data_path("test.matrix"), "r") as src:
-                with open(matrix_file, "w") as dst:
-                    dst.write(src.read())
-
-        self.monkeypatch.setattr("q2_skani._methods._run_skani", mock_run_skani)
-
-        # Run the comparison
-        result = compare_seqs_skani(
-            genomes=mags,
-            threads=4,
-            min_fraction=0.2,
-            min_ani=80.0,
-            small_genomes=True,
+            _run_skani([sys.executable, "-c", script], _process_skani_matrix)
+
+    @patch("q2_skani.skani.shutil.which", return_value="/opt/bin/skani")
+    @patch("q2_skani.skani.subprocess.Popen")
+    def test_run_skani_popen_args(self, mock_popen, mock_which):
+        """Test the arguments skani is started with."""
+        proc = mock_popen.return_value.__enter__.return_value
+        proc.returncode = 0
+
+        _run_skani(["skani", "triangle"], lambda fh: None)
+
+        mock_which.assert_called_once_with("skani")
+        self.assertEqual(mock_popen.call_args.args[0], ["skani", "triangle"])
+        self.assertEqual(mock_popen.call_args.kwargs["executable"], "/opt/bin/skani")
+        self.assertFalse(mock_popen.call_args.kwargs["close_fds"])
+        self.assertEqual(mock_popen.call_args.kwargs["bufsize"], 1 << 16)
+
+    @unittest.skipUnless(
+        subprocess._USE_POSIX_SPAWN, "posix_spawn is not used on this platform"
+    )
+    def test_run_skani_resolves_executable(self):
+        """Test that the resolved executable is started with posix_spawn."""
+        cmd = [sys.executable, "-c", "print('all good')"]
+        spawn = subprocess.Popen._posix_spawn
+
+        with patch.object(
+            subprocess.Popen, "_posix_spawn", autospec=True, side_effect=spawn
+        ) as mock_spawn:
+            obs = _run_skani(cmd, lambda fh: fh.read())
+
+        mock_spawn.assert_called_once()
+        self.assertEqual(obs, "all good\n")
+
+    def test_run_skani_failure(self):
+        """Test that a failed run reports the tail of stderr."""
+        script = (
+            "import sys\n"
+            "for i in range(500):\n"
+            "    print(f'line {i}', file=sys.stderr)\n"
+            "sys.exit(3)"
         )
 
-        # Check the results
-        self.assertIsInstance(result, pd.DataFrame)
-        self.assertEqual(result.shape, (3, 3))
-        self.assertEqual(list(result.index), ["genome1", "genome2", "genome3"])
-        self.assertEqual(result.loc["genome1", "genome2"], 99.9)
+        with self.assertRaisesRegex(RuntimeError, "exit code 3") as cm:
+            _run_skani([sys.executable, "-c", script], lambda fh: fh.read())
 
-    def test_compare_seqs_skani_no_fasta_files(self):
-        """Test error handling when no FASTA files are found."""
-        # Create mock MAG sequences with no FASTA files
-        mags = MockMAGSequencesDirFmt([])
+        msg = str(cm.exception)
+        self.assertIn(f"Command: {shlex.join([sys.executable, '-c', script])}", msg)
+        self.assertIn("stderr:\nline 300\n", msg)
+        self.assertIn("line 499", msg)
+        self.assertNotIn("line 299", msg)
 
-        # Test that comparison raises an error
-        with self.assertRaisesRegex(RuntimeError, "No FASTA files found"):
-            compare_seqs_skani(genomes=mags)
+    def test_run_skani_failure_invalid_utf8(self):
+        """Test that undecodable stderr bytes do not mask a skani failure."""
+        script = "import sys; sys.stderr.buffer.write(b'bad \\xff byte'); sys.exit(2)"
 
-    def test_compare_seqs_skani_error(self):
-        """Test error handling when skani fails."""
-        # Create mock MAG sequences
-        mags = MockMAGSequencesDirFmt(["genome1.fasta"])
+        with self.assertRaisesRegex(RuntimeError, "exit code 2") as cm:
+            _run_skani([sys.executable, "-c", script], lambda fh: fh.read())
+
+        self.assertIn("bad \ufffd byte", str(cm.exception))
 
-        # Mock skani to raise an error
-        def mock_run_skani(cmd: List[str]):
-            raise RuntimeError("skani failed")
+    def test_run_skani_failure_while_reading(self):
+        """Test that a skani failure takes precedence over output errors."""
+        script = "import sys; print('partial'); sys.exit(1)"
 
-        self.monkeypatch.setattr("q2_skani._methods._run_skani", mock_run_skani)
+        with self.assertRaisesRegex(RuntimeError, "exit code 1") as cm:
+            _run_skani([sys.executable, "-c", script], _process_skani_matrix)
 
-        # Test that comparison raises an error
-        with self.assertRaisesRegex(RuntimeError, "Failed to run skani comparison"):
-            compare_seqs_skani(genomes=mags)
+        self.assertIsInstance(cm.exception.__cause__, ValueError)
 
 
 class MockMAGSequencesDirFmt:
     """Mock class for MAGSequencesDirFmt."""
 
-    def __init__(self, fasta_files: List[str]):
-        self.path = Path(tempfile.mkdtemp())
+    def __init__(self, fasta_files: List[str], root: Optional[str] = None):
+        # created under root (e.g. the test's temp_dir) so that it gets
+        # cleaned up together with it
+        self.path = Path(tempfile.mkdtemp(dir=root))
         for file in fasta_files:
-            (self.path / file).touch()
+            (self.path / file).write_text(f">{file}\nACGT\n")